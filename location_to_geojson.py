@@ -1,9 +1,14 @@
+from collections import Counter
 from dataclasses import dataclass
 import json
+from multiprocessing import Pool
 from pathlib import Path
 from sys import argv
 
 INTERMEDIATE_POINTS = 3
+PRECISION = 3
+# shift applied to the rounded coordinates so they are never negative
+CELL_OFFSET = 2**30
 
 
 @dataclass
@@ -70,88 +75,110 @@ def read_file(fname) -> dict[str, list[Activity]]:
     return ret
 
 
+def cell_id(lat: float, lng: float, scale: int) -> int:
+    """Packs the coordinates rounded to 1/scale in a single integer.
+
+    Integers are much cheaper to hash and store than a Point.
+    """
+    return ((round(lat * scale) + CELL_OFFSET) << 32) | (
+        round(lng * scale) + CELL_OFFSET
+    )
+
+
+def cell_point(cid: int, scale: int) -> Point:
+    """Inverse of cell_id, returns the rounded point."""
+    return Point(
+        ((cid >> 32) - CELL_OFFSET) / scale,
+        ((cid & 0xFFFFFFFF) - CELL_OFFSET) / scale,
+    )
+
+
+def interp_cells(points: list[Point], scale: int, n: int) -> set[int]:
+    """Cells crossed by the path, interpolating n points per segment."""
+    visited_cells = set()
+    fractions = [s / n for s in range(n)]
+    for p1, p2 in zip(points, points[1:]):
+        # brutal interpolation
+        delta_lat = p2.lat - p1.lat
+        delta_lng = p2.lng - p1.lng
+        visited_cells.update(
+            cell_id(p1.lat + delta_lat * f, p1.lng + delta_lng * f, scale)
+            for f in fractions
+        )
+    return visited_cells
+
+
 def activity_grid(
     activities: dict[str, list[Activity]], rounding: int
-) -> dict[str, list[Point]]:
+) -> dict[str, Counter[int]]:
     """Aggregates waypoints to the given rounding.
 
     Rounding is here the number of decimals after the decimal separator.
     So rounding = 3 means that the first 3 decimals are used
+
+    The cells are identified by the id returned by cell_id.
     """
-    ret: dict[str, dict[Point, int]] = {}
+    scale = 10**rounding
+    ret: dict[str, Counter[int]] = {}
     for activity_type, activities in activities.items():
-        ret[activity_type] = {}
+        cells: Counter[int] = Counter()
         for activity in activities:
             # assume only some activities actually let you explore the world
             if activity_type not in ("WALKING", "CYCLING", "RUNNING"):
-                for point in activity.points:
-                    rounded_point = Point(
-                        round(point.lat * (10**rounding)) / (10**rounding),
-                        round(point.lng * (10**rounding)) / (10**rounding),
-                    )
-                    if rounded_point not in ret[activity_type]:
-                        ret[activity_type][rounded_point] = 1
-                    ret[activity_type][rounded_point] += 1
+                cells.update(
+                    cell_id(point.lat, point.lng, scale) for point in activity.points
+                )
             else:
-                visited_points = set()
-                for p1, p2 in zip(activity.points, activity.points[1:]):
-                    # brutal interpolation
-                    for s in range(INTERMEDIATE_POINTS):
-                        lat_i = p1.lat + (p2.lat - p1.lat) * s / INTERMEDIATE_POINTS
-                        lng_i = p1.lng + (p2.lng - p1.lng) * s / INTERMEDIATE_POINTS
-                        rounded_point = Point(
-                            round(lat_i * (10**rounding)) / (10**rounding),
-                            round(lng_i * (10**rounding)) / (10**rounding),
-                        )
-                        visited_points.add(rounded_point)
-                for rounded_point in visited_points:
-                    if rounded_point not in ret[activity_type]:
-                        ret[activity_type][rounded_point] = 1
-                    ret[activity_type][rounded_point] += 1
+                cells.update(
+                    interp_cells(activity.points, scale, INTERMEDIATE_POINTS)
+                )
+        ret[activity_type] = cells
 
     return ret
 
 
+def process_file(fname) -> dict[str, Counter[int]]:
+    """Reads and aggregates a single file, runs in a worker process."""
+    print(f"Processing {fname}")
+    return activity_grid(read_file(fname), PRECISION)
+
+
 if __name__ == "__main__":
     if len(argv) == 1:
         print("Usage: python3 location_to_geojson.py /path/to/google/takeout/Semantic Location History")
         exit(1)
-    PRECISION = 3
-    total_grid = {"ALL": {}}
-    for fname in Path(argv[1]).glob("**/*.json"):
-        print(f"Processing {fname}")
-        data = read_file(fname)
-        grid = activity_grid(data, PRECISION)
-        for activity_type, points in grid.items():
-            if activity_type not in total_grid:
-                total_grid[activity_type] = {}
-            for point, count in points.items():
-                if point not in total_grid[activity_type]:
-                    total_grid[activity_type][point] = count
-                total_grid[activity_type][point] += count
-
-                if point not in total_grid["ALL"]:
-                    total_grid["ALL"][point] = count
-                total_grid["ALL"][point] += count
-
-    for activity_type, point_count in total_grid.items():
-        features = []
-        for tile, count in point_count.items():
-            coords = [
-                [tile.lng, tile.lat],
-                [tile.lng, tile.lat + 1 / 10**PRECISION],
-                [tile.lng + 1 / 10**PRECISION, tile.lat + 1 / 10**PRECISION],
-                [tile.lng + 1 / 10**PRECISION, tile.lat],
-                [tile.lng, tile.lat],
-                [tile.lng + 1 / 10**PRECISION, tile.lat + 1 / 10**PRECISION],
-            ]
-            feature = {
-                "type": "Feature",
-                "properties": {"type": activity_type, "count": count},
-                "geometry": {"type": "LineString", "coordinates": coords},
-            }
-            features.append(feature)
-
-        geojson = {"type": "FeatureCollection", "features": features}
+    total_grid: dict[str, Counter[int]] = {"ALL": Counter()}
+    # files are independent, process them on all the cores
+    with Pool() as pool:
+        for grid in pool.imap_unordered(
+            process_file, list(Path(argv[1]).glob("**/*.json"))
+        ):
+            for activity_type, cells in grid.items():
+                total_grid.setdefault(activity_type, Counter()).update(cells)
+                total_grid["ALL"].update(cells)
+
+    scale = 10**PRECISION
+    step = 1 / scale
+    for activity_type, cell_count in total_grid.items():
+        # written one feature per line, to not hold them all in memory
         with open(f"history_{activity_type}.geojson", "w") as fw:
-            json.dump(geojson, fw, indent=2)
+            fw.write('{"type": "FeatureCollection", "features": [\n')
+            separator = ""
+            for cid, count in cell_count.items():
+                tile = cell_point(cid, scale)
+                coords = [
+                    [tile.lng, tile.lat],
+                    [tile.lng, tile.lat + step],
+                    [tile.lng + step, tile.lat + step],
+                    [tile.lng + step, tile.lat],
+                    [tile.lng, tile.lat],
+                    [tile.lng + step, tile.lat + step],
+                ]
+                feature = {
+                    "type": "Feature",
+                    "properties": {"type": activity_type, "count": count},
+                    "geometry": {"type": "LineString", "coordinates": coords},
+                }
+                fw.write(separator + json.dumps(feature))
+                separator = ",\n"
+            fw.write("\n]}\n")
@@ -1,34 +1,73 @@
-import json
-from datetime import datetime
 import argparse
 
+import cv2
+import ijson
 import imageio
 import numpy as np
-from scipy import ndimage
+import orjson
+from PIL import Image
 from matplotlib import pyplot as plt
 import matplotlib.image as img
 from skimage.transform import resize
 from moviepy.video.io.ImageSequenceClip import ImageSequenceClip
 
 
-def iso8601_to_epoch(iso_date: str):
-    return datetime.fromisoformat(iso_date[:19]).strftime('%s')
+def parse_timestamps(timestamps):
+    """Parse the ISO 8601 timestamps of the location data once.
 
-def get_locations(
-    location_data, x0, x1, y0, y1, scaling_factor,
-    minutes_since_last_midnight_filter=None,
-        ):
-    """Produce an heatmap matrix of the given bounding box and scaling.
+    Returns
+    -------
+    Tuple[ndarray, ndarray]
+        The UTC epoch in seconds and the minutes after UTC midnight
+    """
+    epochs = np.array(timestamps, dtype='datetime64[s]').astype(np.int64)
+    sample_minutes = ((epochs // 60) % (24 * 60)).astype(np.int16)
+    return epochs, sample_minutes
+
+
+def read_locations(input_file: str, streaming: bool = False):
+    """Read the Google location data export, keeping only the needed fields.
+
+    By default the whole file is parsed at once with orjson, which is the
+    fastest option when it fits in memory. The export can be several GB,
+    in that case use streaming to parse it incrementally with ijson.
+
+    Returns
+    -------
+    Tuple[ndarray, ndarray, ndarray, ndarray]
+        Longitudes and latitudes in E7 format, UTC epoch in seconds and
+        minutes after UTC midnight of every location
+    """
+    longitudes, latitudes, timestamps = [], [], []
+    with open(input_file, 'rb') as f:
+        if streaming:
+            location_data = ijson.items(f, 'locations.item')
+        else:
+            location_data = orjson.loads(f.read())['locations']
+        for loc in location_data:
+            longitudes.append(loc['longitudeE7'])
+            latitudes.append(loc['latitudeE7'])
+            # the ISO string without fraction and timezone, always UTC
+            timestamps.append(loc['timestamp'][:19])
+    epochs, sample_minutes = parse_timestamps(timestamps)
+    return (
+        np.array(longitudes, dtype=np.int64),
+        np.array(latitudes, dtype=np.int64),
+        epochs,
+        sample_minutes,
+    )
+
+
+def prepare_locations(locations, x0, x1, y0, y1, scaling_factor):
+    """Compute once the pixel position and weight of every location.
 
     Coordinates are in E7 format (decimal degrees multiplied by 10^7,
     and rounded to be integers).
 
-    Optionally a range of minutes after midnight can be given.
-
     Parameters
     ----------
-    location_data : dict
-        the 'location' key of from Google location data export
+    locations : Tuple[ndarray, ndarray, ndarray, ndarray]
+        the location data as returned by read_locations
     x0 : int
         longitude min, in E7 format
     x1 : int
@@ -41,50 +80,96 @@ def get_locations(
         scaling factor, the higher the bigger the matrix
         1000 means about 1 cell per 10 meters
         1 px = 10 meters = ~0.00009 lat/long degrees
+
+    Returns
+    -------
+    Tuple[Tuple[int, int], int, ndarray, ndarray, ndarray]
+        The size of the heatmap, the total number of locations, and the
+        flattened cell index, weight and minutes after UTC midnight of the
+        locations inside the bounding box
+    """
+    height_in_pixels = int((y1 - y0) / scaling_factor)
+    width_in_pixels = int((x1 - x0) / scaling_factor)
+    map_size = (height_in_pixels, width_in_pixels)
+
+    longitudes, latitudes, epochs, sample_minutes = locations
+
+    x = np.rint((longitudes - x0) / scaling_factor).astype(np.intp)
+    y = np.rint((latitudes - y0) / scaling_factor).astype(np.intp)
+    in_bounds = (
+        (x >= 0) & (x < width_in_pixels) &
+        (y >= 0) & (y < height_in_pixels))
+
+    # weight each point by the minutes spent there before the next one
+    weights = np.ones(len(epochs), dtype=np.float32)
+    weights[:-1] = np.diff(epochs) / 60
+
+    # only the locations inside the map are kept, frames don't check it again
+    return (
+        map_size,
+        len(epochs),
+        y[in_bounds] * width_in_pixels + x[in_bounds],
+        weights[in_bounds],
+        sample_minutes[in_bounds],
+    )
+
+
+def get_locations(
+    prepared_locations,
+    minutes_since_last_midnight_filter=None,
+        ):
+    """Produce an heatmap matrix from the prepared locations.
+
+    Optionally a range of minutes after midnight can be given.
+
+    Parameters
+    ----------
+    prepared_locations : Tuple
+        the locations as returned by prepare_locations
     minutes_since_last_midnight_filter : Tuple[int, int], optional
         the number of minutes, if specified will consider only the points
         with a timestamp that is N minutes after UTC midnight, where N is
-        between the two given values
+        at least the first value and less than the second
 
     Returns
     -------
     Tuple[ndarray, int, int]
         The resulting heatmap, and the number of processed and skipped entries
     """
+    map_size, processed, cells, weights, sample_minutes = prepared_locations
 
-    height_in_pixels = int((y1 - y0) / scaling_factor)
-    width_in_pixels = int((x1 - x0) / scaling_factor)
-    map_size = (height_in_pixels, width_in_pixels)
+    if minutes_since_last_midnight_filter is not None:
+        mask = (
+            (sample_minutes >= minutes_since_last_midnight_filter[0]) &
+            (sample_minutes < minutes_since_last_midnight_filter[1]))
+        cells, weights = cells[mask], weights[mask]
 
-    place_map = np.zeros(map_size)
-
-    processed, skipped = 0, 0
-    for index_location, loc in enumerate(location_data):
-        processed += 1
-        if minutes_since_last_midnight_filter is not None:
-            dt = datetime.fromtimestamp(int(iso8601_to_epoch(loc['timestamp']))/1000)
-            sample_minutes = dt.hour * 60 + dt.minute
-            if (sample_minutes < minutes_since_last_midnight_filter[0] or
-                    sample_minutes > minutes_since_last_midnight_filter[1]):
-                skipped += 1
-                continue
-        x = round((int(loc['longitudeE7'] - x0)) / scaling_factor)
-        y = round((int(loc['latitudeE7'] - y0)) / scaling_factor)
-        if (x >= place_map.shape[1] or
-                y >= place_map.shape[0] or x < 0 or y < 0):
-            skipped += 1
-        else:
-            if index_location + 1 < len(location_data):
-                place_map[y][x] += (
-                    (int(iso8601_to_epoch(loc['timestamp'])) -
-                        int(iso8601_to_epoch(location_data[index_location + 1]['timestamp'])))
-                    / (1000 * 60))
-            else:
-                place_map[y][x] += 1
+    place_map = np.bincount(
+        cells, weights=weights, minlength=map_size[0] * map_size[1])
+    place_map = place_map.reshape(map_size).astype(np.float32)
+    skipped = processed - len(weights)
     print('dots processed:', processed, 'dots outside the rectangle:', skipped)
     return place_map, processed, skipped
 
 
+def composite_frame(base_map, heatmap):
+    """Blend the heatmap over the base map like the reference image does.
+
+    The base map is drawn with alpha 0.48 over a white background, then
+    the heatmap with the Spectral colormap and alpha 0.5, with the first
+    row at the bottom since it is the southernmost one.
+
+    Returns
+    -------
+    ndarray
+        The RGB image as uint8
+    """
+    composite = np.clip(base_map, 0, 1) * 0.48 + 0.52
+    colored = plt.cm.Spectral(np.flipud(heatmap))[..., :3]
+    composite = composite * 0.5 + colored * 0.5
+    return (composite * 255).astype(np.uint8)
+
+
 def main(
     input_file: str,
     base_file: str,
@@ -94,9 +179,12 @@ def main(
     y0: int,
     y1: int,
     scaling_factor: int,
+    streaming: bool = False,
         ):
     print('Reading location data JSON...')
-    location_data = json.loads(open(input_file).read())['locations']
+    locations = read_locations(input_file, streaming)
+    prepared_locations = prepare_locations(
+        locations, x0, x1, y0, y1, scaling_factor)
     print('Data imported. Processing...')
 
     bins = list(range(1, 100, 1))
@@ -105,22 +193,20 @@ def main(
     frame_persistence_factor = 4
 
     all_minutes_starts = list(range(0, 24*60, minutes_step))
-    base_map = np.mean(img.imread(base_file), axis=-1)
+    base_map = np.mean(img.imread(base_file), axis=-1, dtype=np.float32)
     base_map = np.stack([base_map, base_map, base_map], axis=-1)
     moving_average_frame = None
     quintiles = None
     filenames = []
-    fig = None
+    frames = []
+    # reused across frames to avoid allocating big matrices every time
+    place_map_blurred = np.empty(prepared_locations[0], dtype=np.float32)
+    place_map_binned = np.empty(prepared_locations[0], dtype=np.float32)
     for frame_idx, selected_minute in enumerate(
             [None] + all_minutes_starts):
         print(f'frame {frame_idx} of {len(all_minutes_starts)}')
         place_map, processed, skipped = get_locations(
-            location_data,
-            x0,
-            x1,
-            y0,
-            y1,
-            scaling_factor,
+            prepared_locations,
             minutes_since_last_midnight_filter=((
                 selected_minute, selected_minute + minutes_step)
                 if selected_minute is not None else None))
@@ -131,72 +217,71 @@ def main(
             print('no points for this map, generating an empty one')
             place_map_draw = place_map
         else:
-            place_map_blurred = ndimage.filters.gaussian_filter(
-                place_map, 1)
-            flattened = place_map_blurred.flatten()
+            # same kernel size and border handling as scipy gaussian_filter
+            cv2.GaussianBlur(
+                place_map, (0, 0), 1,
+                dst=place_map_blurred, borderType=cv2.BORDER_REFLECT)
             if selected_minute is None:
                 # the first iteration is over non-time filtered point
                 # and is used to generate the bin once for all
                 quintiles = np.percentile(
-                    flattened[np.nonzero(flattened)], bins)
-            place_map_draw = np.searchsorted(
-                quintiles, place_map_blurred) / len(bins)
+                    place_map_blurred[place_map_blurred != 0], bins)
+            place_map_binned[...] = np.digitize(
+                place_map_blurred, quintiles, right=True)
+            place_map_binned *= 1 / len(bins)
+            place_map_draw = place_map_binned
 
         if base_map.shape != place_map_draw.shape:
             base_map = resize(
                 base_map, place_map_draw.shape, anti_aliasing=True)
 
         if moving_average_frame is None:
-            moving_average_frame = place_map_draw
+            # copy, the binned matrix is overwritten by the next frame
+            moving_average_frame = place_map_draw.copy()
         else:
-            moving_average_frame = (
-                (moving_average_frame +
-                    place_map_draw * frame_persistence_factor)
-                / (1 + frame_persistence_factor))
+            moving_average_frame += place_map_draw * frame_persistence_factor
+            moving_average_frame /= 1 + frame_persistence_factor
         print('min/avg/max of original matrix:'
               f'{np.min(place_map_draw,axis=(0,1))}/'
               f'{np.average(place_map_draw,axis=(0,1))}/'
               f'{np.max(place_map_draw,axis=(0,1))}')
-        my_dpi = 90
-        if fig is None:
-            fig = plt.figure(
-                    figsize=(
-                        place_map_draw.shape[1]/my_dpi,
-                        place_map_draw.shape[0]/my_dpi),
-                    dpi=my_dpi)
-        if selected_minute is not None:
-            plt.title(f'Location history for zone: {place_name} and'
-                      f' hour {int(selected_minute / 60)}:'
-                      f'{(selected_minute % 60):02}'
-                      f' + {minutes_step} minutes (UTC)')
-        else:
-            plt.title(f'Location history for zone: {place_name}'
-                      ' at any moment of the day')
-
-        plt.xlabel('Longitude')
-        plt.ylabel('Latitude')
-        # extent is used to show the coordinates in the axis
-        plt.imshow(
-            base_map,
-            extent=[v/10000000 for v in [x0, x1, y0, y1]],
-            alpha=0.48)
-        plt.imshow(
-            moving_average_frame,
-            cmap=plt.cm.Spectral,
-            extent=[v/10000000 for v in [x0, x1, y0, y1]],
-            origin='lower',
-            alpha=0.5)
         if selected_minute is not None:
             # note the :04 to add the trailing 0s
             # so the lexicographic order is numeric as well
             # and the subsequent command line command follows it
             frame_file = (f'locations_in_{place_name}_time_'
                           f'{frame_idx:04}.png')
-            plt.savefig(frame_file)
+            frame = composite_frame(base_map, moving_average_frame)
+            imageio.imwrite(frame_file, frame)
             filenames.append(frame_file)
+            frames.append(frame)
         else:
+            # the reference image is drawn with matplotlib
+            # to have title and coordinates on the axis
+            my_dpi = 90
+            fig = plt.figure(
+                    figsize=(
+                        place_map_draw.shape[1]/my_dpi,
+                        place_map_draw.shape[0]/my_dpi),
+                    dpi=my_dpi)
+            plt.title(f'Location history for zone: {place_name}'
+                      ' at any moment of the day')
+            plt.xlabel('Longitude')
+            plt.ylabel('Latitude')
+            # extent is used to show the coordinates in the axis
+            plt.imshow(
+                base_map,
+                extent=[v/10000000 for v in [x0, x1, y0, y1]],
+                alpha=0.48)
+            plt.imshow(
+                moving_average_frame,
+                cmap=plt.cm.Spectral,
+                extent=[v/10000000 for v in [x0, x1, y0, y1]],
+                origin='lower',
+                alpha=0.5)
             plt.savefig(f'locations_in_{place_name}'
                         '_all_time_weighted.png')
+            plt.close(fig)
         if selected_minute is None:
             # for simplicity, everything is drawn on the same matrix
             # it has to be "cleared" to avoid a "flash" on the first frame
@@ -206,8 +291,6 @@ def main(
             # for the total time, otherwise, calculating the
             # quintiles over the whole day, every frame would be dark
             quintiles = quintiles * len(all_minutes_starts)
-        # clear the figure, faster than deleting and recreating a new one
-        plt.clf()
     print('generating the GIF...')
     with imageio.get_writer(
         f'{place_name}.gif',
@@ -215,22 +298,17 @@ def main(
         duration=0.3,
         subrectangles=True,
             ) as writer:
-        for filename in filenames:
+        for filename, image in zip(filenames, frames):
             print(f'Appending frame {filename} to the GIF')
-            image = imageio.imread(filename)
             # GIF is quite space hungry
             if image.shape[0] > 500:
-                factor = image.shape[0] / 500
-                image = resize(
-                    image,
-                    (round(image.shape[0] / factor),
-                        round(image.shape[1] / factor),
-                        image.shape[2]),
-                    anti_aliasing=True)
+                thumbnail = Image.fromarray(image)
+                thumbnail.thumbnail((image.shape[1], 500), Image.LANCZOS)
+                image = np.asarray(thumbnail)
             writer.append_data(image)
 
     print('generating the video...')
-    isc = ImageSequenceClip(filenames, fps=4)
+    isc = ImageSequenceClip(frames, fps=4)
     isc.write_videofile(f'{place_name}.webm')
 
 
@@ -253,6 +331,10 @@ if __name__ == '__main__':
     parser.add_argument(
         'base_file',
         help='the map background for the given coordinates')
+    parser.add_argument(
+        '--streaming',
+        action='store_true',
+        help='parse the input incrementally, for exports not fitting in RAM')
 
     args = parser.parse_args()
     main(
@@ -264,4 +346,5 @@ if __name__ == '__main__':
         args.y0,
         args.y1,
         args.scaling_factor,
+        args.streaming,
         )